@@ -6,27 +6,72 @@ Ensures AI mastering system is ready with training data in production environmen
 
 import os
 import logging
-from pathlib import Path
-from intelligent_mastering_engine import IntelligentMasteringEngine
-from training_database import TrainingDatabase
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# AI_INIT_VERBOSE=0 skips the engine status dump when only the exit code matters
+AI_INIT_VERBOSE = os.getenv("AI_INIT_VERBOSE", "1") == "1"
+
+# AI_READINESS_PROBE=1: only check that the training database opens (see below)
+AI_READINESS_PROBE = os.getenv("AI_READINESS_PROBE") == "1"
+
+# Fields of a seeded template row that are the same for every genre, built
+# once; each row only adds its genre-specific keys on top.
+# Placeholder spectral series: (feature, first value, step) over 10 bins.
+SPECTRAL_SERIES = (
+    ('spectral_centroid', 1000.0, 500),
+    ('spectral_rolloff', 5000.0, 1000),
+    ('zero_crossing_rate', 0.1, 0.02),
+    ('mfcc', 0.0, 0.5),
+    ('chroma', 0.5, 0.05),
+    ('tempo_beat', 120.0, 10),
+)
+BASE_TRACK = {
+    'duration': 180.0,
+    'lra': 8.0,
+    'true_peak': -1.0,
+    # One 10-value array per feature in the stored analysis JSON
+    # (training_tracks_json), not 60 scalar keys; rounded so float noise
+    # (0.12000000000000001) isn't serialized
+    'spectral_features': {name: [round(start + i * step, 4) for i in range(10)]
+                          for name, start, step in SPECTRAL_SERIES},
+}
+
 def initialize_production_ai():
-    """Initialize AI mastering system for production deployment."""
+    """
+    Initialize AI mastering system for production deployment.
+
+    With AI_READINESS_PROBE=1 and the database already in place, only check
+    that it answers a trivial query and return, without seeding or loading
+    the engine; meant for repeated startup probes.
+    """
     try:
+        if AI_READINESS_PROBE:
+            import sqlite3
+            from contextlib import closing
+            from training_database import DB_PATH
+            if DB_PATH.is_file():
+                with closing(sqlite3.connect(DB_PATH)) as conn:
+                    conn.execute("SELECT 1").fetchone()
+                return True
+        
         logger.info("🚀 Initializing AI Mastering System for Production...")
         
-        # Check if training database exists
-        db_path = Path(__file__).parent / "training_data.db"
+        # Imported here so importing this module doesn't load the engine's deps
+        from training_database import TrainingDatabase
+        from intelligent_mastering_engine import get_engine
         
-        if not db_path.exists():
-            logger.warning("⚠️  Training database not found. Creating minimal database...")
-            
-            # Create minimal training database for production
-            db = TrainingDatabase()
+        # Opening creates the database if it's missing; seed it only while it
+        # holds no tracks (a new file, or one left empty by a failed seed)
+        db = TrainingDatabase()
+        existing = db.existing_genres()
+        
+        if existing:
+            logger.info("⏭  Skipping seeding: %d genres already in the training database", len(existing))
+        else:
+            logger.warning("⚠️  Training database is empty. Creating minimal database...")
             
             # Add some basic genre templates if none exist
             basic_templates = {
@@ -38,49 +83,48 @@ def initialize_production_ai():
             }
             
             logger.info("📊 Creating basic genre templates...")
+            rows = []
             for genre, params in basic_templates.items():
                 # Create mock training data entry
-                track_data = {
+                rows.append({
+                    **BASE_TRACK,
                     'file_path': f'/production/reference/{genre}_reference.mp3',
                     'genre': genre,
-                    'duration': 180.0,
                     'integrated_lufs': params['lufs_target'],
-                    'lra': 8.0,
-                    'true_peak': -1.0,
                     'compression_profile': params['compression_profile']
-                }
-                
-                # Add basic spectral data
-                for i in range(10):
-                    track_data[f'spectral_centroid_{i}'] = 1000.0 + i * 500
-                    track_data[f'spectral_rolloff_{i}'] = 5000.0 + i * 1000
-                    track_data[f'zero_crossing_rate_{i}'] = 0.1 + i * 0.02
-                    track_data[f'mfcc_{i}'] = float(i * 0.5)
-                    track_data[f'chroma_{i}'] = 0.5 + i * 0.05
-                    track_data[f'tempo_beat_{i}'] = 120.0 + i * 10
-                
-                db.store_track_analysis(track_data)
+                })
             
-            logger.info("✅ Basic training database created")
+            # One transaction for all templates rather than a commit per genre;
+            # re-checks emptiness under the write lock in case another worker
+            # seeded since existing_genres() above. The full JSON is kept so
+            # the placeholder spectral features are stored
+            if db.store_track_analyses_bulk(rows, only_if_empty=True, store_full_json=True):
+                logger.info("✅ Basic training database created")
+            else:
+                logger.info("⏭  Skipping seeding: another initializer seeded the database first")
         
-        # Initialize AI engine
+        # Initialize AI engine. Not overlapped with seeding: it reads the seeded
+        # templates, and the seed is one commit of a few ms
         logger.info("🧠 Loading AI Mastering Engine...")
-        ai_engine = IntelligentMasteringEngine()
+        ai_engine = get_engine(db)  # shares the seeding connection
         
-        logger.info(f"📊 AI Engine Status:")
-        logger.info(f"   - Genre templates: {len(ai_engine.genre_templates)}")
-        logger.info(f"   - AI profiles: {len(ai_engine.ai_profiles)}")
-        
-        if ai_engine.genre_templates:
-            logger.info("🎯 Available genres:")
-            for genre, template in ai_engine.genre_templates.items():
-                logger.info(f"   - {genre}: {template['reference_count']} refs, LUFS: {template['target_parameters']['lufs_target']:.1f}")
+        if AI_INIT_VERBOSE and logger.isEnabledFor(logging.INFO):
+            logger.info("📊 AI Engine Status:")
+            logger.info("   - Genre templates: %d", len(ai_engine.genre_templates))
+            logger.info("   - Reference tracks: %d", ai_engine.total_reference_tracks)
+            logger.info("   - AI profiles: %d", len(ai_engine.ai_profiles))
+            
+            if ai_engine.genre_templates:
+                logger.info("🎯 Available genres:")
+                for genre, template in ai_engine.genre_templates.items():
+                    logger.info("   - %s: %d refs, LUFS: %.1f", genre, template['reference_count'],
+                                template['target_parameters']['lufs_target'])
         
         logger.info("🎉 AI Mastering System successfully initialized for production!")
         return True
         
     except Exception as e:
-        logger.error(f"❌ Failed to initialize AI system: {str(e)}")
+        logger.error("❌ Failed to initialize AI system: %s", e)
         logger.error("🔄 Falling back to basic mastering mode...")
         return False
 
@@ -1,34 +1,52 @@
-from sqlalchemy import Column, String, Integer, DateTime, Enum, Float
+from sqlalchemy import Column, String, Integer, DateTime, Float, Index, text
 from sqlalchemy.orm import declarative_base
 from datetime import datetime
 import enum
 
 Base = declarative_base()
 
-class JobStatus(enum.Enum):
-uploaded = "uploaded"
-processing = "processing"
-preview_ready = "preview_ready"
-awaiting_payment = "awaiting_payment"
-paid = "paid"
-done = "done"
-failed = "failed"
+class JobStatus(str, enum.Enum):
+    # Names for the status strings; the column itself stores plain text
+    uploaded = "uploaded"
+    processing = "processing"
+    preview_ready = "preview_ready"
+    awaiting_payment = "awaiting_payment"
+    paid = "paid"
+    done = "done"
+    failed = "failed"
+
+VALID_STATUSES = frozenset(s.value for s in JobStatus)
 
 class Job(Base):
-__tablename__ = "jobs"
-id = Column(String, primary_key=True)
-original_filename = Column(String)
-upload_key = Column(String) # s3 key
-preview_key = Column(String) # s3 key
-output_key = Column(String) # s3 key
-lufs = Column(Float)
-status = Column(Enum(JobStatus), default=JobStatus.uploaded)
-created_at = Column(DateTime, default=datetime.utcnow)
+    __tablename__ = "jobs"
+    id = Column(String, primary_key=True)
+    original_filename = Column(String)
+    upload_key = Column(String) # s3 key
+    preview_key = Column(String) # s3 key
+    output_key = Column(String) # s3 key
+    lufs = Column(Float)
+    # String, not Enum: no per-row enum conversion, and no database enum type
+    # to ALTER when a status is added; set_status() does the validation
+    status = Column(String(16), default=JobStatus.uploaded.value, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Workers poll for in-flight jobs oldest first; index only those rows
+        Index("ix_jobs_processing_created_at", "created_at",
+              postgresql_where=text("status = 'processing'"),
+              sqlite_where=text("status = 'processing'")),
+    )
+
+    def set_status(self, status: str) -> None:
+        value = status.value if isinstance(status, JobStatus) else status
+        if value not in VALID_STATUSES:
+            raise ValueError(f"Unknown job status: {status!r}")
+        self.status = value
 
 class Payment(Base):
-__tablename__ = "payments"
-id = Column(String, primary_key=True) # Stripe session id
-job_id = Column(String)
-amount = Column(Integer)
-currency = Column(String)
-created_at = Column(DateTime, default=datetime.utcnow)
+    __tablename__ = "payments"
+    id = Column(String, primary_key=True) # Stripe session id
+    job_id = Column(String)
+    amount = Column(Integer)
+    currency = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
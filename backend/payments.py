@@ -1,5 +1,5 @@
 # backend/payments.py  (REPLACE ENTIRE FILE)
-import os, stripe
+import os, time, stripe
 from fastapi import HTTPException
 
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
@@ -51,18 +51,31 @@ def verify_session_paid(session_id: str) -> bool:
     except Exception:
         return False
 
+# email -> time it was last confirmed subscribed. Only positives are cached, so
+# someone who subscribes right after a miss is recognized on the next check.
+SUBSCRIBER_TTL = 60.0
+SUBSCRIBER_CACHE_MAX = 10_000
+_active_subscribers = {}
+
 def is_active_subscriber(email: str) -> bool:
     """Check if there is an active or trialing subscription for the customer email."""
+    now = time.monotonic()
+    seen = _active_subscribers.get(email)
+    if seen is not None and now - seen < SUBSCRIBER_TTL:
+        return True
     try:
-        customers = stripe.Customer.list(email=email, limit=1)
+        # One round trip: the customer comes back with its live subscriptions
+        # (Customer.search would too, but its index lags new customers)
+        customers = stripe.Customer.list(email=email, limit=1, expand=["data.subscriptions"])
         if not customers.data:
             return False
-        cust_id = customers.data[0].id
-        subs = stripe.Subscription.list(customer=cust_id, status="all", limit=10)
+        subs = customers.data[0].subscriptions
         for sub in subs.data:
             if sub.status in ("active", "trialing"):
+                if len(_active_subscribers) >= SUBSCRIBER_CACHE_MAX:
+                    _active_subscribers.clear()
+                _active_subscribers[email] = now
                 return True
         return False
     except Exception:
         return False
-
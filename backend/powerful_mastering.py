@@ -4,84 +4,412 @@ Powerful Mastering DSP - Simple but effective mastering that WORKS
 Based on proven loudness standards and aggressive processing
 """
 
+import io
+import os
+import re
+import json
 import subprocess
+import shutil
+import tempfile
+import threading
 import logging
+from functools import lru_cache
 from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
-def master_audio_powerful(input_path: str, output_path: str, target_lufs: float = -11.0) -> bool:
+# Bump whenever the mastering chain changes: cached masters are keyed on it.
+PRESET_VERSION = "4"
+
+# Large copy buffer: a 64 KiB default means thousands of read/write syscalls
+# for a single multi-MB upload.
+COPY_BUFSIZE = 16 * 1024 * 1024
+
+# Only real errors reach stderr by default; at most this much of it is kept.
+STDERR_TAIL_BYTES = 64 * 1024
+
+# FFmpeg auto-detects one thread per core, so N concurrent jobs would start
+# N x cores threads; split the cores between the jobs the server runs at once.
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", str(min(os.cpu_count() or 1, 4))))
+FFMPEG_THREADS = max(1, (os.cpu_count() or 1) // max(1, MAX_CONCURRENT_JOBS))
+FFMPEG_THREAD_FLAGS = [
+    "-threads", str(FFMPEG_THREADS),
+    "-filter_threads", str(FFMPEG_THREADS),
+    "-filter_complex_threads", str(FFMPEG_THREADS),
+]
+
+
+def iter_chunks(src: BinaryIO):
+    """
+    Yield ``src`` from its current position as memoryview slices of one
+    reused COPY_BUFSIZE buffer; each slice is only valid until the next one.
+    """
+    buf = bytearray(COPY_BUFSIZE)
+    view = memoryview(buf)
+    while n := src.readinto(view):
+        yield view[:n]
+
+
+def copy_stream(src: BinaryIO, dst: BinaryIO, hasher=None) -> None:
+    """
+    Copy ``src`` from its start into ``dst``.
+
+    Uploads that Starlette has spooled to a real temp file are transferred
+    with os.sendfile (kernel-side, no user-space copy); in-memory spools fall
+    back to a large-buffer copyfileobj. When a hashlib-style ``hasher`` is
+    given the bytes are hashed in the same pass, which rules out sendfile.
+    """
+    src.seek(0)
+    if hasher is not None:
+        for chunk in iter_chunks(src):
+            hasher.update(chunk)
+            dst.write(chunk)
+        return
+
+    # Look at the SpooledTemporaryFile's backing file: calling fileno() on the
+    # wrapper itself would force an in-memory spool to roll over to disk.
+    backing = getattr(src, "_file", src)
+    try:
+        in_fd = backing.fileno()
+        out_fd = dst.fileno()
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+        return
+
+    dst.flush()
+    offset = 0
+    while True:
+        try:
+            sent = os.sendfile(out_fd, in_fd, offset, COPY_BUFSIZE)
+        except OSError:
+            if offset:
+                raise
+            # sendfile unsupported for this fd pair (e.g. non-Linux pipe)
+            shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+            return
+        if sent == 0:
+            break
+        offset += sent
+
+
+def _feed_stdin(stream: BinaryIO, pipe: BinaryIO) -> None:
+    """Copy an upload stream into FFmpeg's stdin, then close it to signal EOF."""
+    try:
+        copy_stream(stream, pipe)
+    except BrokenPipeError:
+        pass  # FFmpeg exited early; its stderr explains why
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+# Every render is a fresh FFmpeg process. An in-process PyAV pipeline for the
+# preview chain was measured as no faster (0.14-0.17 s either way on a 2 s clip,
+# slower on full songs: per-frame Python overhead outweighs process start-up),
+# so the CLI stays the single rendering path. Spawning FFmpeg itself costs only
+# a few ms, so a pool of long-lived FFmpeg workers would not pay for itself.
+# The same goes for encoding previews with in-process LAME bindings: the preview
+# is encoded by FFmpeg's libmp3lame in the same run that decodes, filters and
+# watermarks it, so there is no decoded PCM in Python to hand such an encoder;
+# using one would mean piping PCM out of FFmpeg and back in. Nor are
+# concurrent jobs batched into one multi-input FFmpeg run: it would save those
+# few ms per song, but make every song wait for the slowest and fail together.
+def run_ffmpeg(args: list[str], stdin_stream: Optional[BinaryIO] = None,
+               timeout: Optional[float] = None, loglevel: str = "error") -> str:
+    """
+    Run an FFmpeg command, raising RuntimeError with its stderr on failure.
+    Returns the tail of stderr (logged at ``loglevel``) on success.
+
+    When ``stdin_stream`` is given the command should read ``-i pipe:0``; the
+    stream is fed from a background thread so the upload never touches disk.
+    The process is killed if it runs longer than ``timeout`` seconds.
+
+    stdout is discarded and stderr goes to an anonymous temp file, so a
+    chatty FFmpeg can never block on a full pipe and no reader thread is needed.
+    """
+    args = [args[0], "-nostats", "-loglevel", loglevel, *FFMPEG_THREAD_FLAGS, *args[1:]]
+    with tempfile.TemporaryFile() as errlog:
+        proc = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE if stdin_stream is not None else subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=errlog,
+        )
+        feeder = None
+        if stdin_stream is not None:
+            feeder = threading.Thread(target=_feed_stdin, args=(stdin_stream, proc.stdin), daemon=True)
+            feeder.start()
+        try:
+            proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            raise RuntimeError(f"FFmpeg timed out after {timeout:g}s")
+        finally:
+            if feeder is not None:
+                feeder.join()
+
+        size = errlog.seek(0, os.SEEK_END)
+        errlog.seek(max(0, size - STDERR_TAIL_BYTES))
+        log = errlog.read().decode("utf-8", errors="ignore")
+        if proc.returncode != 0:
+            raise RuntimeError(log)
+        return log
+
+
+# Master EQ curve as (Hz, dB) points; firequalizer interpolates between them
+MASTER_EQ = [
+    (20, 0.0),
+    (60, 2.0),       # Sub bass punch
+    (90, 1.5),       # Bass power
+    (250, -1.5),     # Clean muddy mids
+    (1200, 0.8),     # Vocal presence
+    (3500, 2.0),     # High-mid clarity
+    (6000, 1.5),     # Presence boost
+    (10000, 1.2),    # Air/sparkle
+]
+MASTER_EQ_ENTRIES = ";".join(f"entry({f},{g})" for f, g in MASTER_EQ)
+
+
+@lru_cache(maxsize=256)
+def _probe_duration(input_path: str, size: int, mtime_ns: int) -> float:
+    """ffprobe's duration for one version of a file; raises when it can't tell."""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+         "-of", "default=noprint_wrappers=1:nokey=1", str(input_path)],
+        capture_output=True, text=True, timeout=15
+    )
+    return float(result.stdout.strip())
+
+
+def probe_duration(input_path: str) -> Optional[float]:
+    """
+    Duration of a media file in seconds via ffprobe, or None if unknown.
+
+    Memoized per path, size and mtime, so the value probed for /preview is
+    reused by the measurement and master renders of /process-full, while a
+    file rewritten in place is probed again. Failures (a timeout, a file
+    ffprobe can't read yet) aren't cached.
+    """
+    if input_path == "pipe:0":
+        return None
+    try:
+        st = os.stat(input_path)
+        return _probe_duration(str(input_path), st.st_size, st.st_mtime_ns)
+    except (OSError, subprocess.TimeoutExpired, ValueError):
+        return None
+
+
+def job_timeout(input_path: str, default: float) -> float:
+    """
+    Wall-clock cap for an FFmpeg job: 4x the input's duration (at least 30 s),
+    or ``default`` when the duration can't be probed (e.g. piped input).
+    """
+    duration = probe_duration(input_path)
+    if duration is None:
+        return default
+    return max(30.0, 4 * duration)
+
+
+# PROVEN MASTERING CHAIN - everything ahead of loudness normalization
+MASTER_PRE_LOUDNORM = ",".join([
+    # 1. Clean up subsonic rumble
+    "highpass=f=25",
+    
+    # 2. Gentle saturation for warmth and glue (simplified)
+    "aexciter=amount=0.15",
+    
+    # 3. POWERFUL EQ - Shape the sound (one FFT pass instead of 7 biquads)
+    f"firequalizer=gain_entry='{MASTER_EQ_ENTRIES}':zero_phase=on",
+    
+    # 4. POWERFUL COMPRESSION - Single-stage aggressive
+    "acompressor=threshold=-20dB:ratio=6.0:attack=5:release=50:makeup=8",
+])
+MASTER_TP = -1.0
+MASTER_LRA = 7
+
+
+def master_chain(target_lufs: float, measured: Optional[dict] = None) -> str:
+    """
+    Build the competition-loud mastering filter chain for a LUFS target.
+    With ``measured`` (from measure_master_loudness) loudnorm runs its
+    second, linear pass instead of single-pass dynamic normalization.
+    """
+    loudnorm = f"loudnorm=I={target_lufs}:TP={MASTER_TP}:LRA={MASTER_LRA}"
+    if measured:
+        loudnorm += (
+            f":measured_I={measured['input_i']}:measured_TP={measured['input_tp']}"
+            f":measured_LRA={measured['input_lra']}:measured_thresh={measured['input_thresh']}"
+            ":linear=true"
+        )
+    return ",".join([
+        MASTER_PRE_LOUDNORM,
+        
+        # 5. LOUDNESS NORMALIZATION - This makes it LOUD
+        loudnorm,
+        f"aresample={MASTER_SAMPLE_RATE}",  # loudnorm outputs 192 kHz; limit at the final rate
+        
+        # 6. Final brick-wall limiter - Maximum loudness  
+        "alimiter=limit=0.95:attack=1:release=25"
+    ])
+
+
+def measure_master_loudness(input_path: str,
+                            input_stream: Optional[BinaryIO] = None) -> Optional[dict]:
+    """
+    First loudnorm pass: measure the signal as it reaches the master's
+    loudnorm stage. The result doesn't depend on the LUFS target, so one
+    measurement serves every genre. Returns None if it can't be taken.
+    """
+    try:
+        cmd = [
+            "ffmpeg", "-y",
+            "-i", str(input_path),
+            "-af", f"{MASTER_PRE_LOUDNORM},loudnorm=TP={MASTER_TP}:LRA={MASTER_LRA}:print_format=json",
+            "-f", "null", "-"
+        ]
+        log = run_ffmpeg(cmd, stdin_stream=input_stream,
+                         timeout=job_timeout(input_path, 300), loglevel="info")
+        stats = json.loads(log[log.rindex("{"):log.rindex("}") + 1])
+        return {k: stats[k] for k in ("input_i", "input_tp", "input_lra", "input_thresh")}
+    except Exception as e:
+        logger.warning(f"Loudness measurement failed, using single-pass loudnorm: {e}")
+        return None
+
+
+# Lighter mastering for preview
+PREVIEW_CHAIN = ",".join([
+    "highpass=f=30",
+    "equalizer=f=80:width_type=h:width=0.7:g=1.0",
+    "equalizer=f=3000:width_type=h:width=0.6:g=1.2",
+    "acompressor=threshold=-18dB:ratio=2.5:attack=5:release=50:makeup=2",
+    "loudnorm=I=-14:TP=-1:LRA=9",
+    "aresample=44100",
+    "alimiter=limit=0.89"  # -1 dBFS (alimiter takes a linear limit)
+])
+
+# Watermark beep mixed into the preview: filter input [1:a] is the sine source.
+WATERMARK_INPUT = ["-f", "lavfi", "-i", "sine=frequency=880:duration=0.3"]
+
+
+def _watermarked_preview_graph(src_label: str, out_label: str) -> str:
+    return (
+        f"[{src_label}]{PREVIEW_CHAIN}[clean];"
+        "[1:a]volume=0.08[beep];"
+        f"[clean][beep]amix=inputs=2:duration=first:dropout_transition=0[{out_label}]"
+    )
+
+
+# LAME's quality knob: 7 is its fast preset (0 is the slowest). Fine for the
+# watermarked 128k preview; masters keep LAME's default (3).
+PREVIEW_LAME_QUALITY = ["-compression_level", "7"]
+PREVIEW_OUTPUT_ARGS = ["-ac", "2", "-ar", "44100", "-b:a", "128k", *PREVIEW_LAME_QUALITY,
+                       "-t", "30", "-f", "mp3"]
+
+# Master encodings selectable with OUTPUT_CODEC: (file extension, output args).
+# Opus at 160k is transparent for most material and encodes faster than LAME
+# at 320k; libopus only takes 48 kHz among the usual rates. FLAC is for
+# archival masters: lossless, and far cheaper to encode than either.
+MASTER_FORMATS = {
+    "mp3": (".mp3", 44100, ["-ac", "2", "-b:a", "320k", "-f", "mp3"]),
+    "opus": (".ogg", 48000, ["-ac", "2", "-c:a", "libopus", "-b:a", "160k",
+                             "-vbr", "on", "-f", "ogg"]),
+    "flac": (".flac", 44100, ["-ac", "2", "-c:a", "flac", "-f", "flac"]),
+}
+OUTPUT_CODEC = os.getenv("OUTPUT_CODEC", "mp3").lower()
+if OUTPUT_CODEC not in MASTER_FORMATS:
+    logger.warning(f"Unknown OUTPUT_CODEC {OUTPUT_CODEC!r}, using mp3")
+    OUTPUT_CODEC = "mp3"
+MASTER_EXT, MASTER_SAMPLE_RATE, _master_codec_args = MASTER_FORMATS[OUTPUT_CODEC]
+MASTER_OUTPUT_ARGS = ["-ar", str(MASTER_SAMPLE_RATE), *_master_codec_args]
+
+# Genre-specific LUFS targets
+GENRE_TARGETS = {
+    "trap": -10.5,
+    "hiphop": -11.0,
+    "drill": -10.0,
+    "amapiano": -10.0,
+    "pop": -11.0,
+    "dancehall": -10.5,
+    "afro": -10.5,
+    "rnb": -12.0,
+    "slow song": -13.0,
+    "ballad": -13.0,
+    "general": -11.0
+}
+
+
+# ebur128's closing summary: "Integrated loudness:\n    I:   -11.0 LUFS"
+EBUR128_INTEGRATED = re.compile(r"Integrated loudness:\s*I:\s*(-?[\d.]+) LUFS")
+
+
+def master_audio_powerful(input_path: str, output_path: str, target_lufs: float = -11.0,
+                          input_stream: Optional[BinaryIO] = None,
+                          measured: Optional[dict] = None,
+                          measure: bool = False) -> Tuple[bool, Optional[float]]:
     """
     Create LOUD, professional master with clear difference from input.
     Uses proven DSP chain for streaming platforms.
     
     Args:
-        input_path: Input audio file
+        input_path: Input audio file ("pipe:0" when input_stream is given)
         output_path: Output audio file
         target_lufs: Target loudness (-9 to -14 LUFS, default -11 for modern loud)
+        input_stream: Optional file object piped to FFmpeg's stdin
+        measured: Optional loudnorm first-pass stats (two-pass normalization)
+        measure: Also measure the master's integrated loudness, in the same
+            FFmpeg run (an asplit branch into ebur128), not a second decode
     
     Returns:
-        True if successful
+        (success, integrated LUFS of the master, or None when not measured
+        or the measurement couldn't be read)
     """
     
     try:
         logger.info(f"🔥 Starting POWERFUL mastering: target {target_lufs} LUFS")
         
-        # PROVEN MASTERING CHAIN - Competition loud with quality
-        filter_chain = ",".join([
-            # 1. Clean up subsonic rumble
-            "highpass=f=25",
-            
-            # 2. Gentle saturation for warmth and glue (simplified)
-            "aexciter=amount=0.15",
-            
-            # 3. POWERFUL EQ - Shape the sound
-            "equalizer=f=60:width_type=h:width=0.8:g=2.0",      # Sub bass punch
-            "equalizer=f=90:width_type=h:width=0.7:g=1.5",       # Bass power
-            "equalizer=f=250:width_type=h:width=0.5:g=-1.5",     # Clean muddy mids
-            "equalizer=f=1200:width_type=h:width=0.6:g=0.8",     # Vocal presence
-            "equalizer=f=3500:width_type=h:width=0.6:g=2.0",     # High-mid clarity
-            "equalizer=f=6000:width_type=h:width=0.7:g=1.5",     # Presence boost
-            "equalizer=f=10000:width_type=h:width=0.8:g=1.2",    # Air/sparkle
-            
-            # 4. POWERFUL COMPRESSION - Single-stage aggressive
-            "acompressor=threshold=-20dB:ratio=6.0:attack=5:release=50:makeup=8",
-            
-            # 5. LOUDNESS NORMALIZATION - This makes it LOUD
-            f"loudnorm=I={target_lufs}:TP=-1.0:LRA=7",
-            
-            # 6. Final brick-wall limiter - Maximum loudness  
-            "alimiter=limit=0.95:attack=1:release=25"
-        ])
-        
         # Run FFmpeg with powerful processing
+        if measure:
+            graph = [
+                "-filter_complex",
+                f"[0:a]{master_chain(target_lufs, measured)},asplit=2[out][meas];"
+                "[meas]ebur128=framelog=quiet[loud]",
+                "-map", "[out]",
+            ]
+        else:
+            graph = ["-af", master_chain(target_lufs, measured)]
         cmd = [
             "ffmpeg", "-y",
             "-i", str(input_path),
-            "-af", filter_chain,
-            "-ar", "44100",
-            "-ac", "2",
-            "-b:a", "320k",
-            "-f", "mp3",
-            str(output_path)
+            *graph,
+            *MASTER_OUTPUT_ARGS,
+            str(output_path),
         ]
+        if measure:
+            cmd += ["-map", "[loud]", "-f", "null", "-"]
         
         logger.info(f"🎛️  Applying powerful mastering chain...")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-        
-        if result.returncode != 0:
-            logger.error(f"Mastering failed: {result.stderr}")
-            return False
+        log = run_ffmpeg(cmd, stdin_stream=input_stream, timeout=job_timeout(input_path, 300),
+                         loglevel="info" if measure else "error")
         
         logger.info(f"✅ Powerful master created at {target_lufs} LUFS")
-        return True
+        lufs = None
+        if measure:
+            found = EBUR128_INTEGRATED.findall(log)
+            lufs = float(found[-1]) if found else None
+        return True, lufs
         
     except Exception as e:
         logger.error(f"❌ Powerful mastering error: {e}")
-        return False
+        return False, None
 
 
-def master_audio_genre_optimized(input_path: str, output_path: str, genre: str = "general") -> bool:
+def master_audio_genre_optimized(input_path: str, output_path: str, genre: str = "general",
+                                 input_stream: Optional[BinaryIO] = None,
+                                 measured: Optional[dict] = None) -> bool:
     """
     Genre-optimized mastering with proven loudness targets.
     
@@ -94,58 +422,33 @@ def master_audio_genre_optimized(input_path: str, output_path: str, genre: str =
     - Ballad/Slow: -13.0 LUFS (dynamic but present)
     """
     
-    # Genre-specific LUFS targets
-    genre_targets = {
-        "trap": -10.5,
-        "hiphop": -11.0,
-        "drill": -10.0,
-        "amapiano": -10.0,
-        "pop": -11.0,
-        "dancehall": -10.5,
-        "afro": -10.5,
-        "rnb": -12.0,
-        "slow song": -13.0,
-        "ballad": -13.0,
-        "general": -11.0
-    }
-    
-    target_lufs = genre_targets.get(genre.lower(), -11.0)
+    target_lufs = GENRE_TARGETS.get(genre.lower(), -11.0)
     logger.info(f"🎯 Genre: {genre} → Target: {target_lufs} LUFS")
     
-    return master_audio_powerful(input_path, output_path, target_lufs)
+    success, _ = master_audio_powerful(input_path, output_path, target_lufs,
+                                       input_stream=input_stream, measured=measured)
+    return success
 
 
-def create_preview_with_watermark(input_path: str, output_path: str) -> bool:
+def create_preview_with_watermark(input_path: str, output_path: str,
+                                  input_stream: Optional[BinaryIO] = None) -> bool:
     """
     Create watermarked preview with light mastering.
+    Pass input_path="pipe:0" together with input_stream to read from a pipe.
     """
     try:
-        # Lighter mastering for preview
-        preview_chain = ",".join([
-            "highpass=f=30",
-            "equalizer=f=80:width_type=h:width=0.7:g=1.0",
-            "equalizer=f=3000:width_type=h:width=0.6:g=1.2",
-            "acompressor=threshold=-18dB:ratio=2.5:attack=5:release=50:makeup=2",
-            "loudnorm=I=-14:TP=-1:LRA=9",
-            "alimiter=limit=-1.0"
-        ])
-        
         cmd = [
             "ffmpeg", "-y",
             "-i", str(input_path),
-            "-f", "lavfi", "-i", "sine=frequency=880:duration=0.3",
-            "-filter_complex",
-            f"[0:a]{preview_chain}[clean];"
-            "[1:a]volume=0.08[beep];"
-            "[clean][beep]amix=inputs=2:duration=first:dropout_transition=0[out]",
+            *WATERMARK_INPUT,
+            "-filter_complex", _watermarked_preview_graph("0:a", "out"),
             "-map", "[out]",
-            "-ac", "2", "-ar", "44100", "-b:a", "128k",
-            "-t", "30",
+            *PREVIEW_OUTPUT_ARGS,
             str(output_path)
         ]
         
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
-        return result.returncode == 0
+        run_ffmpeg(cmd, stdin_stream=input_stream, timeout=job_timeout(input_path, 120))
+        return True
         
     except Exception as e:
         logger.error(f"Preview creation error: {e}")
@@ -9,45 +9,40 @@ test_input = '/tmp/test_quiet.mp3'
 test_output = '/tmp/test_mastered.mp3'
 
 print("1️⃣ Creating quiet test audio...")
-subprocess.run([
+# Encode the input and measure it in the same run, instead of decoding the
+# MP3 again later just to measure it
+created = subprocess.run([
     'ffmpeg', '-y', '-f', 'lavfi', '-i', 'sine=frequency=440:duration=5',
-    '-af', 'volume=0.1',
-    '-ar', '44100', '-b:a', '192k',
-    test_input
-], capture_output=True, timeout=10)
+    '-filter_complex', 'volume=0.1,asplit[enc][meas];[meas]ebur128=framelog=quiet[detect]',
+    '-map', '[enc]', '-ar', '44100', '-b:a', '192k', test_input,
+    '-map', '[detect]', '-f', 'null', '-'
+], capture_output=True, text=True, timeout=10)
 print("   ✅ Created\n")
 
 print("2️⃣ Running mastering...")
-from powerful_mastering import master_audio_powerful
+from powerful_mastering import EBUR128_INTEGRATED, master_audio_powerful
 
-success = master_audio_powerful(test_input, test_output, target_lufs=-11.0)
+# measure=True also measures the master with ebur128 in the run that renders it
+success, output_lufs = master_audio_powerful(test_input, test_output, target_lufs=-11.0, measure=True)
 
 if not success:
     print("   ❌ MASTERING FAILED!\n")
     sys.exit(1)
 
+if output_lufs is None:
+    print("   ❌ Master rendered, but its loudness couldn't be measured\n")
+    sys.exit(1)
+
 print("   ✅ Completed\n")
 
 print("3️⃣ Comparing loudness...\n")
 
-# Check input
-result = subprocess.run([
-    'ffmpeg', '-i', test_input, '-af', 'volumedetect', '-f', 'null', '-'
-], capture_output=True, text=True, timeout=10)
-
-print("📊 INPUT:")
-for line in result.stderr.split('\n'):
-    if 'mean_volume' in line or 'max_volume' in line:
-        print(f"   {line.strip()}")
-
-# Check output  
-result2 = subprocess.run([
-    'ffmpeg', '-i', test_output, '-af', 'volumedetect', '-f', 'null', '-'
-], capture_output=True, text=True, timeout=10)
+input_lufs = float(EBUR128_INTEGRATED.findall(created.stderr)[-1])
+print(f"📊 INPUT:  {input_lufs:.1f} LUFS")
+print(f"📊 OUTPUT: {output_lufs:.1f} LUFS (should be LOUDER)")
 
-print("\n📊 OUTPUT (should be LOUDER):")
-for line in result2.stderr.split('\n'):
-    if 'mean_volume' in line or 'max_volume' in line:
-        print(f"   {line.strip()}")
+if output_lufs <= input_lufs:
+    print("\n❌ Master is not louder than the input!")
+    sys.exit(1)
 
 print("\n✅ Test complete!")
@@ -5,10 +5,10 @@ export type ProgressFn = (percent: number) => void;
 const API_BASE = import.meta.env.VITE_API_URL || 
   (import.meta.env.DEV ? "/api" : "https://audiomaster-pro-2024-api.onrender.com");
 
-function postFormXHR<T>(path: string, form: FormData, onProgress?: ProgressFn): Promise<T> {
+function sendXHR<T>(method: string, path: string, body: XMLHttpRequestBodyInit, onProgress?: ProgressFn): Promise<T> {
   return new Promise((resolve, reject) => {
     const xhr = new XMLHttpRequest();
-    xhr.open("POST", `${API_BASE}${path}`);
+    xhr.open(method, `${API_BASE}${path}`);
     xhr.upload.onprogress = (e) => {
       if (onProgress && e.lengthComputable) {
         onProgress(Math.max(1, Math.round((e.loaded / e.total) * 100))); // 1..100
@@ -28,14 +28,22 @@ function postFormXHR<T>(path: string, form: FormData, onProgress?: ProgressFn):
       }
     };
     xhr.onerror = () => reject(new Error("Network error"));
-    xhr.send(form);
+    xhr.send(body);
   });
 }
 
+function postFormXHR<T>(path: string, form: FormData, onProgress?: ProgressFn): Promise<T> {
+  return sendXHR<T>("POST", path, form, onProgress);
+}
+
 export async function uploadForPreview(file: File, onProgress?: ProgressFn) {
+  // Stream the raw file (no multipart) so the backend writes it straight to disk
+  const { job_id } = await sendXHR<{ job_id: string }>(
+    "PUT", `/upload?filename=${encodeURIComponent(file.name)}`, file, onProgress
+  );
   const form = new FormData();
-  form.append("file", file);
-  return postFormXHR<{ job_id: string; preview_url: string }>("/preview", form, onProgress);
+  form.append("job_id", job_id);
+  return postFormXHR<{ job_id: string; preview_url: string }>("/preview", form);
 }
 
 export async function createCheckout(job_id: string) {
@@ -59,9 +67,19 @@ export async function processFull(params: {
 }, onProgress?: ProgressFn) {
   const form = new FormData();
   form.append("job_id", params.job_id);
-  form.append("file", params.file);
   if (params.session_id) form.append("session_id", params.session_id);
   if (params.email) form.append("email", params.email);
-  return postFormXHR<{ download_url: string }>("/process-full", form, onProgress);
+  // The backend keeps the upload from /preview, so skip re-sending the file;
+  // it answers 404 only if that copy is gone, and then we upload again.
+  try {
+    return await postFormXHR<{ download_url: string }>("/process-full", form, onProgress);
+  } catch (e: any) {
+    if (!String(e?.message).startsWith("HTTP 404")) throw e;
+    // Re-send as a raw body with the fields in the query string (no multipart)
+    const query = new URLSearchParams({ job_id: params.job_id, filename: params.file.name });
+    if (params.session_id) query.set("session_id", params.session_id);
+    if (params.email) query.set("email", params.email);
+    return sendXHR<{ download_url: string }>("POST", `/process-full/stream?${query}`, params.file, onProgress);
+  }
 }
 